@@ -1,10 +1,19 @@
 import streamlit as st
+import streamlit.components.v1 as components
 from openai import OpenAI
-import PyPDF2
-import json
+import pypdfium2 as pdfium
+import orjson
 import os
+import hashlib
+import math
+import sqlite3
+import tempfile
 import time
 import random
+import re
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import pandas as pd
 import plotly.express as px
 from dotenv import load_dotenv
@@ -33,16 +42,6 @@ st.markdown("""
         font-weight: bold;
         color: white;
     }
-    .timer-box {
-        font-size: 20px;
-        font-weight: bold;
-        color: #d32f2f;
-        padding: 10px;
-        border: 2px solid #d32f2f;
-        border-radius: 5px;
-        text-align: center;
-        margin-bottom: 10px;
-    }
     .diff-easy { background-color: #2196F3; }
     .diff-medium { background-color: #FF9800; }
     .diff-hard { background-color: #f44336; }
@@ -51,139 +50,470 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Persistence Functions ---
-DATA_FILE = "quiz_data.json"
+DATA_FILE = "quiz_data.db"
+LEGACY_DATA_FILE = "quiz_data.json"
+
+@st.cache_resource
+def init_db():
+    """Creates the Elo table once per process (WAL) and imports any legacy JSON ratings."""
+    with closing(sqlite3.connect(DATA_FILE, isolation_level=None)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS elo(topic TEXT PRIMARY KEY, elo INTEGER)")
+        # One-time import of ratings saved by the old JSON store
+        if os.path.exists(LEGACY_DATA_FILE) and conn.execute("SELECT COUNT(*) FROM elo").fetchone()[0] == 0:
+            try:
+                with open(LEGACY_DATA_FILE, 'rb') as f:
+                    data = orjson.loads(f.read())
+                conn.executemany(
+                    "INSERT OR IGNORE INTO elo VALUES(?,?)",
+                    [(topic, d['elo']) for topic, d in data.items() if 'elo' in d]
+                )
+            except:
+                pass
+    return True
+
+def connect_db():
+    """Opens a fresh autocommit connection; one per call keeps sessions from sharing a connection."""
+    init_db()
+    return closing(sqlite3.connect(DATA_FILE, isolation_level=None))
 
 def load_topic_data(topic_name):
     """Loads the saved Elo for a specific topic."""
-    if not os.path.exists(DATA_FILE):
-        return 1200 # Default start
     try:
-        with open(DATA_FILE, 'r') as f:
-            data = json.load(f)
-            return data.get(topic_name, {}).get('elo', 1200)
+        with connect_db() as conn:
+            row = conn.execute("SELECT elo FROM elo WHERE topic=?", (topic_name,)).fetchone()
+        return row[0] if row else 1200 # Default start
     except:
         return 1200
 
 def save_topic_data(topic_name, elo):
     """Saves the Elo for a specific topic."""
-    data = {}
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-        except:
-            data = {}
-    
-    # Update data
-    if topic_name not in data:
-        data[topic_name] = {}
-    data[topic_name]['elo'] = elo
-    
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f)
+    with connect_db() as conn:
+        conn.execute(
+            "INSERT INTO elo VALUES(?,?) ON CONFLICT(topic) DO UPDATE SET elo=excluded.elo",
+            (topic_name, int(elo))
+        )
 
 # --- Helper Functions ---
 
+@st.cache_resource
 def get_openai_client(api_key):
+    """One client per API key, so reruns and worker threads share its connection pool."""
     return OpenAI(api_key=api_key)
 
+@st.cache_resource
+def get_executor():
+    """Shared worker pool for background OpenAI calls (survives reruns)."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_grading_executor():
+    """Separate pool for grading, so user-visible grades never queue behind question generation."""
+    return ThreadPoolExecutor(max_workers=2)
+
+_executor = get_executor()
+_grading_executor = get_grading_executor()
+
+PDF_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".quiz_cache", "pdfs")
+PDF_MAX_CHARS = 2000000 # Bounds extraction work; prompts are bounded by retrieval instead
+
+def pdf_cache_path(pdf_hash, ext):
+    """Location of a cached artifact (extracted text, embeddings) for a PDF."""
+    return os.path.join(PDF_CACHE_DIR, f"{pdf_hash}.{ext}")
+
+def write_cache_file(path, write):
+    """Calls write(f) on a temp file, then moves it into place so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
 @st.cache_data
 def extract_text_from_pdf(pdf_file):
+    """Extracts PDF text, reusing the on-disk copy keyed by the file's MD5 hash."""
+    pdf_hash = hashlib.md5(pdf_file.getvalue()).hexdigest()
+    cache_path = pdf_cache_path(pdf_hash, f"{PDF_MAX_CHARS}.txt") # Text depends on the cap
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        pass # Cache miss
     try:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
+        pdf_doc = pdfium.PdfDocument(pdf_file.getvalue())
+        parts = []
+        total = 0
+        for page in pdf_doc:
+            page_text = page.get_textpage().get_text_range() or ""
+            parts.append(page_text)
+            total += len(page_text)
+            if total >= PDF_MAX_CHARS:
+                break
+        pdf_doc.close()
+        text = "".join(parts)[:PDF_MAX_CHARS]
+        try:
+            write_cache_file(cache_path, lambda f: f.write(text.encode('utf-8')))
+        except OSError:
+            pass # Caching is best-effort
         return text
     except Exception as e:
         st.error(f"Error reading PDF: {e}")
         return None
 
+# --- Context Retrieval ---
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHUNK_CHARS = 2000 # ~500 tokens
+TOP_K_CHUNKS = 8
+EMBEDDING_BATCH = 256 # Chunks per embeddings request, well under the per-request token limit
+
+def build_context_index(client, context, topic_name, pdf_hash=None):
+    """
+    Splits the context into ~500-token chunks and embeds them once.
+    Embeddings for a PDF are cached on disk next to its extracted text.
+    """
+    chunks = [context[i:i + CHUNK_CHARS] for i in range(0, len(context), CHUNK_CHARS)]
+    index = {"chunks": chunks, "matrix": None, "topic": topic_name}
+    if len(chunks) <= TOP_K_CHUNKS:
+        return index # Already fits in the window, nothing to select
+    
+    cache_path = pdf_cache_path(pdf_hash, "npy") if pdf_hash else None
+    if cache_path:
+        try:
+            matrix = np.load(cache_path)
+            if len(matrix) == len(chunks):
+                index["matrix"] = matrix
+                return index
+        except (OSError, ValueError):
+            pass # Cache miss
+    try:
+        vectors = []
+        for i in range(0, len(chunks), EMBEDDING_BATCH):
+            response = client.embeddings.create(model=EMBEDDING_MODEL, input=chunks[i:i + EMBEDDING_BATCH])
+            vectors.extend(d.embedding for d in response.data)
+    except Exception as e:
+        st.warning(f"Could not index content, using the first pages instead: {e}")
+        return index
+    index["matrix"] = np.array(vectors, dtype=np.float32)
+    if cache_path:
+        try:
+            write_cache_file(cache_path, lambda f: np.save(f, index["matrix"]))
+        except OSError:
+            pass # Caching is best-effort
+    return index
+
+def retrieve_context(client, index, query, avoid=(), k=TOP_K_CHUNKS, fallback_chars=20000):
+    """
+    Returns the k chunks most similar to `query` (in document order), penalizing
+    chunks close to anything in `avoid`. Falls back to the leading text when
+    the content was not indexed.
+    """
+    if index["matrix"] is None:
+        return "".join(index["chunks"])[:fallback_chars]
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=[query, *avoid])
+    except Exception:
+        return "".join(index["chunks"])[:fallback_chars]
+    vectors = np.array([d.embedding for d in response.data], dtype=np.float32)
+    # OpenAI embeddings are unit length, so the dot product is the cosine similarity
+    scores = index["matrix"] @ vectors[0]
+    if len(vectors) > 1:
+        scores -= 0.5 * (index["matrix"] @ vectors[1:].T).max(axis=1)
+    top = np.sort(np.argsort(scores)[-k:])
+    return "\n...\n".join(index["chunks"][i] for i in top)
+
+ELO_K_FACTOR = 32
+
+def calculate_elo_batch(elos, correct, question_ratings):
+    """
+    Updates Elo ratings based on standard Elo formula; arguments broadcast against each other.
+    """
+    elos = np.asarray(elos, dtype=float)
+    expected = 1 / (1 + 10 ** ((np.asarray(question_ratings, dtype=float) - elos) / 400))
+    new_elos = elos + ELO_K_FACTOR * (np.asarray(correct, dtype=float) - expected)
+    return np.round(new_elos).astype(int)
+
 def calculate_elo(current_elo, is_correct, question_difficulty_rating):
     """
-    Updates Elo rating based on standard Elo formula.
+    Updates a single Elo rating; see calculate_elo_batch.
     """
-    k_factor = 32
-    expected_score = 1 / (1 + 10 ** ((question_difficulty_rating - current_elo) / 400))
-    actual_score = 1 if is_correct else 0
-    new_elo = current_elo + k_factor * (actual_score - expected_score)
-    return round(new_elo)
+    return int(calculate_elo_batch(current_elo, bool(is_correct), question_difficulty_rating))
+
+# (upper Elo bound, label, css class, estimated question rating)
+_TIERS = (
+    (1300, "Easy", "diff-easy", 1100),
+    (1500, "Medium", "diff-medium", 1400),
+    (1700, "Hard", "diff-hard", 1600),
+    (10**9, "Expert", "diff-expert", 1800),
+)
 
 def get_difficulty_label(elo):
     """Returns label, css class, and an estimated 'rating' for that difficulty tier."""
-    if elo < 1300: return "Easy", "diff-easy", 1100
-    elif elo < 1500: return "Medium", "diff-medium", 1400
-    elif elo < 1700: return "Hard", "diff-hard", 1600
-    else: return "Expert", "diff-expert", 1800
-
-def generate_question(client, context, elo, history):
+    return next(((name, css, rating) for bound, name, css, rating in _TIERS if elo < bound), _TIERS[-1][1:])
+
+ELO_TIERS = [rating for _, _, _, rating in _TIERS]
+TIER_LABELS = [name for _, name, _, _ in _TIERS]
+QUESTION_TYPES = ["multiple_choice", "detailed_analysis"]
+
+def new_bandit():
+    """Beta(1, 1) prior on the success rate of each question type."""
+    return {q_type: {"a": 1, "b": 1} for q_type in QUESTION_TYPES}
+
+def choose_question_type(bandit):
+    """Thompson sampling: draw from each type's Beta posterior and take the best."""
+    q_types = list(bandit)
+    draws = np.random.beta([bandit[t]["a"] for t in q_types], [bandit[t]["b"] for t in q_types])
+    return q_types[int(np.argmax(draws))]
+
+def update_bandit(bandit, q_type, is_correct):
+    """Records one graded outcome for the question type that was asked."""
+    if q_type in bandit:
+        bandit[q_type]["a"] += int(is_correct)
+        bandit[q_type]["b"] += 1 - int(is_correct)
+
+def pop_question(tier_queue, q_type):
+    """Pops the oldest queued question of `q_type`, or the oldest of any type."""
+    for i, q in enumerate(tier_queue):
+        if q.get('type') == q_type:
+            return tier_queue.pop(i)
+    return tier_queue.pop(0) if tier_queue else None
+
+def generate_question_batch(client, context_index, recent_tags, elo_tiers=ELO_TIERS, b=4, q_types=None):
     """
-    Generates a question based on Elo and context, focusing on deep understanding.
-    Randomly chooses between Multiple Choice or Detailed Problem/Analysis.
+    Generates `b` questions in a single request, spread round-robin across the Elo tiers.
+    Slot i uses q_types[i] (Multiple Choice or Detailed Problem/Analysis), random if not given.
+    `recent_tags` are sub-topics of recently asked questions, which are avoided.
+    Returns a dict mapping difficulty label -> list of question dicts.
     """
-    diff_label, _, _ = get_difficulty_label(elo)
-    
-    # Randomly select type
-    q_type_selection = random.choice(["multiple_choice", "detailed_analysis"])
-    
-    if q_type_selection == "multiple_choice":
-        q_inst = "Generate a Multiple Choice Question (4 options) that requires critical thinking, deduction, or calculation to solve."
-    else:
-        q_inst = "Generate a 'Detailed Problem' or 'Analysis Request' requiring a step-by-step solution, argument, or literary analysis."
-
-    history_summary = "\n".join([f"Q: {h['question'][:50]}... | Result: {'Correct' if h['is_correct'] else 'Incorrect'}" for h in history[-3:]])
+    slots = []
+    for i in range(b):
+        rating = elo_tiers[i % len(elo_tiers)]
+        label, _, _ = get_difficulty_label(rating)
+        q_type = q_types[i] if q_types else random.choice(QUESTION_TYPES)
+        slots.append(f'{i + 1}. tier: "{label}", difficulty_rating_estimate: {rating}, type: "{q_type}"')
+    slot_list = "\n    ".join(slots)
+
+    context = retrieve_context(
+        client, context_index,
+        f"Core concepts and key ideas of {context_index['topic']}",
+        avoid=recent_tags,
+        fallback_chars=50000
+    )
 
     system_prompt = f"""
     You are an expert Professor in the subject matter of the provided context.
-    Context: {context[:50000]} (Use relevant sections).
-    Current User Rating: {elo} (Level: {diff_label})
+    Context: {context} (Use relevant sections).
+    
+    Task: Generate {b} independent questions, one for each slot below:
+    {slot_list}
     
-    Task: {q_inst}
+    - "multiple_choice": A Multiple Choice Question (4 options) that requires critical thinking, deduction, or calculation to solve.
+    - "detailed_analysis": A 'Detailed Problem' or 'Analysis Request' requiring a step-by-step solution, argument, or literary analysis.
+    Scale the depth of each question to its tier (Easy < Medium < Hard < Expert).
     
     **CRITICAL GUIDELINES**:
     1. **Goal**: Test **Deep Understanding** and **Critical Thinking**, NOT memorization.
     2. **Relevance**: Questions must be tightly bound to the specific content/themes in the Context.
     3. **Math/Science Topics**: Require derivation, calculation, and application of principles. Use LaTeX (single $) for math.
     4. **Humanities/Literature/History Topics**: Require thematic analysis, evidence-based argumentation, comparison, or critique. Do NOT ask for simple dates or names; ask *why* or *how*.
+    5. **Variety**: Each question must cover a different idea from the others.
     
     Output Format (JSON):
     {{
-        "type": "{q_type_selection}",
-        "question": "Question text...",
-        "options": ["A) ...", "B) ...", "C) ...", "D) ..."] (Only for MC, otherwise null),
-        "correct_option": "Option text" (Only for MC, used for internal validation),
-        "hint": "A conceptual hint (e.g., a formula or a thematic lens) without giving away the answer.",
-        "difficulty_rating_estimate": {elo}
+        "questions": [
+            {{
+                "tier": "Tier label from the slot",
+                "type": "Type from the slot",
+                "question": "Question text...",
+                "options": ["A) ...", "B) ...", "C) ...", "D) ..."] (Only for MC, otherwise null),
+                "correct_option": "Exact copy of the correct string from options" (Only for MC, used for internal validation),
+                "correct_index": 0-based index of the correct option in options (Only for MC, otherwise null),
+                "topic_tags": ["1-3 short sub-topic tags this question covers"],
+                "hint": "A conceptual hint (e.g., a formula or a thematic lens) without giving away the answer.",
+                "scoring_rubric": ["Criterion a strong answer must meet", "..."],
+                "model_answer_full": "The ideal step-by-step solution or analytical response (for MC, why the correct option is right).",
+                "difficulty_rating_estimate": Rating from the slot
+            }}
+        ]
     }}
     """
     
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Avoid these recent questions: {history_summary}"}
-            ],
-            response_format={"type": "json_object"}
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "Avoid repeating these sub-topics: " + (", ".join(recent_tags) or "none yet")}
+        ],
+        response_format={"type": "json_object"}
+    )
+    batch = {}
+    for q in orjson.loads(response.choices[0].message.content).get("questions", []):
+        if not isinstance(q, dict) or not q.get("question"):
+            continue
+        try:
+            rating = float(q.get("difficulty_rating_estimate"))
+        except (TypeError, ValueError):
+            rating = None
+        if rating is not None and not math.isfinite(rating):
+            rating = None
+        label = q.get("tier")
+        if label not in TIER_LABELS:
+            if rating is None:
+                continue # Can't tell which tier this question belongs to
+            label, _, _ = get_difficulty_label(rating)
+        if rating is None:
+            rating = ELO_TIERS[TIER_LABELS.index(label)]
+        q["difficulty_rating_estimate"] = rating
+        batch.setdefault(label, []).append(q)
+    return batch
+
+def recent_topic_tags(qs):
+    """Distinct sub-topic tags of the last few questions asked, oldest first."""
+    return list(dict.fromkeys(tag for tags in qs["recent_tags"] for tag in tags))
+
+QUEUE_LOW_WATER = 1 # Refill a tier once it holds this many questions or fewer
+QUEUE_MAX_DEPTH = 3 # Never queue more than this many questions per tier
+REFILL_BATCH = 4 # Most questions requested in one refill
+
+def tiers_to_refill(qs):
+    """Ratings of the current tier and its neighbours that are at the low-water mark, current tier first."""
+    idx = TIER_LABELS.index(get_difficulty_label(qs["elo"])[0])
+    nearby = [i for i in (idx, idx - 1, idx + 1) if 0 <= i < len(TIER_LABELS)]
+    return [ELO_TIERS[i] for i in nearby if len(qs["q_queue"].get(TIER_LABELS[i], [])) <= QUEUE_LOW_WATER]
+
+def queue_needs_refill(qs):
+    """True when the current tier or a neighbour is running low on pre-generated questions."""
+    return bool(tiers_to_refill(qs))
+
+def schedule_refill(qs, client):
+    """
+    Starts a background batch generation for the tiers that are running low,
+    unless one is already in flight. Slots go round-robin over those tiers,
+    topping each up to QUEUE_MAX_DEPTH.
+    """
+    if qs["q_refill"] is not None:
+        return
+    tiers = tiers_to_refill(qs)
+    room = {r: QUEUE_MAX_DEPTH - len(qs["q_queue"].get(get_difficulty_label(r)[0], [])) for r in tiers}
+    slots = []
+    while len(slots) < REFILL_BATCH and any(n > 0 for n in room.values()):
+        for rating in tiers:
+            if room[rating] > 0 and len(slots) < REFILL_BATCH:
+                slots.append(rating)
+                room[rating] -= 1
+    if slots:
+        q_types = [choose_question_type(qs["bandit"]) for _ in slots]
+        qs["q_refill"] = _executor.submit(
+            generate_question_batch, client, qs["context_index"], recent_topic_tags(qs), slots, len(slots), q_types
         )
-        return json.loads(response.choices[0].message.content)
+
+def collect_refill(qs, wait=False, key="q_refill"):
+    """Merges a finished background generation (quiz state `key`) into the question queue."""
+    future = qs[key]
+    if future is None or not (wait or future.done()):
+        return
+    qs[key] = None
+    merge_batch(qs, future)
+
+def merge_batch(qs, future):
+    """Waits for a generation future and adds its questions to the queue."""
+    try:
+        batch = future.result()
     except Exception as e:
         st.error(f"Error generating question: {e}")
+        return
+    for label, questions in batch.items():
+        tier_queue = qs["q_queue"].setdefault(label, [])
+        tier_queue.extend(questions[:max(0, QUEUE_MAX_DEPTH - len(tier_queue))])
+
+def prefetch_question(qs, client, elo):
+    """
+    Speculatively generates one question for the tier `elo` falls in, if that tier
+    is empty and no refill (which always covers nearby tiers) is in flight.
+    """
+    label, _, rating = get_difficulty_label(elo)
+    if qs["q_queue"].get(label) or qs["q_refill"] is not None:
         return None
+    q_types = [choose_question_type(qs["bandit"])]
+    return _executor.submit(generate_question_batch, client, qs["context_index"], recent_topic_tags(qs), [rating], 1, q_types)
+
+def mc_answer_key(question_data):
+    """The exact option string marked correct, or None when the key matches no option."""
+    options = question_data.get('options') or []
+    correct_index = question_data.get('correct_index')
+    if type(correct_index) is int and 0 <= correct_index < len(options):
+        return options[correct_index]
+    if question_data.get('correct_option') in options:
+        return question_data['correct_option']
+    return None
+
+def grade_multiple_choice(question_data, user_answer, answer_key):
+    """Grades an MC answer locally: the selected option must be the key exactly."""
+    is_correct = user_answer == answer_key
+    
+    if is_correct:
+        explanation = "Correct choice."
+    else:
+        explanation = f"The correct answer is: {answer_key}"
+    return {
+        "is_correct": is_correct,
+        "score_percentage": 100 if is_correct else 0,
+        "explanation": explanation,
+        "model_answer": question_data.get('model_answer_full', answer_key),
+        "key_concepts_missed": []
+    }
 
-def evaluate_answer(client, question_data, user_answer, context):
+def evaluate_answer(client, question_data, user_answer, context_index, stream=None):
     """
     Evaluates answer focusing on reasoning, evidence, and methodology.
+    Multiple choice is graded locally when its answer key matches an option; anything
+    else is graded against the rubric and model answer produced alongside the
+    question, falling back to the source context when those are missing. If `stream` is a list, raw response text is
+    appended to it as it arrives.
     """
+    if question_data.get('type') == 'multiple_choice':
+        answer_key = mc_answer_key(question_data)
+        if answer_key is not None:
+            return grade_multiple_choice(question_data, user_answer, answer_key)
+    
+    question_hash = hashlib.md5(orjson.dumps(question_data, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    answer_hash = hashlib.md5(str(user_answer).encode()).hexdigest()
+    try:
+        return grade_free_text(client, question_hash, answer_hash, question_data, user_answer, context_index, stream)
+    except Exception as e:
+        return {"is_correct": False, "explanation": f"Error: {e}", "score_percentage": 0}
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=3600)
+def grade_free_text(_client, question_hash, answer_hash, _question_data, _user_answer, _context_index, _stream=None):
+    """
+    Grades a free-text (or unkeyed MC) answer with gpt-4o-mini. Cached on the (question, answer)
+    hashes so the same submission is never billed twice; errors are raised
+    rather than cached.
+    """
+    question_data, user_answer = _question_data, _user_answer
+    rubric = question_data.get('scoring_rubric')
+    model_answer = question_data.get('model_answer_full')
+    if rubric and model_answer:
+        rubric_lines = "\n    ".join(f"- {item}" for item in rubric)
+        reference = f"""Question-Specific Rubric:
+    {rubric_lines}
+    
+    Model Answer: {model_answer}"""
+    else:
+        reference = f"Context: {retrieve_context(_client, _context_index, question_data['question'])}"
+    
     system_prompt = f"""
     You are a strict academic professor grading an assessment.
     
-    Context: {context[:20000]}
-    
     Question: {question_data['question']}
     Question Type: {question_data.get('type', 'detailed_analysis')}
     Correct Answer/Key (if available): {question_data.get('correct_option', 'N/A')}
     
+    {reference}
+    
     Student Answer: "{user_answer}"
     
     Task: Grade the student's answer based on the subject type.
@@ -200,26 +530,44 @@ def evaluate_answer(client, question_data, user_answer, context):
         "is_correct": boolean (true if the core analysis/solution is sound),
         "score_percentage": integer (0-100),
         "explanation": "Detailed feedback on the reasoning, analysis, or derivation.",
-        "model_answer": "The ideal step-by-step solution or analytical response.",
+        "model_answer": "The ideal step-by-step solution or analytical response." (Omit if a Model Answer is given above),
         "key_concepts_missed": ["Concept A", "Concept B"]
     }}
     """
     
+    response = _client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "Grade this solution."}
+        ],
+        response_format={"type": "json_object"},
+        stream=True
+    )
+    parts = []
+    for chunk in response:
+        delta = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+        parts.append(delta)
+        if _stream is not None:
+            _stream.append(delta)
+    result = orjson.loads("".join(parts))
+    if model_answer:
+        result.setdefault('model_answer', model_answer)
+    return result
+
+def partial_json_field(text, key):
+    """Best-effort read of a string field from a JSON object that is still streaming in."""
+    match = re.search(rf'"{key}"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+    if not match:
+        return ""
+    value = match.group(1).rstrip("\\")
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "Grade this solution."}
-            ],
-            response_format={"type": "json_object"}
-        )
-        return json.loads(response.choices[0].message.content)
-    except Exception as e:
-        return {"is_correct": False, "explanation": f"Error: {e}", "score_percentage": 0}
+        return orjson.loads(f'"{value}"')
+    except ValueError:
+        return value
 
 def generate_analytics_report(client, history, context):
-    history_str = json.dumps(history, indent=2)
+    history_str = orjson.dumps(history, option=orjson.OPT_INDENT_2).decode()
     prompt = f"""
     Analyze this assessment session.
     Context Topic: {context[:500]}...
@@ -242,6 +590,7 @@ if 'quiz_state' not in st.session_state:
         "active": False,
         "finished": False,
         "context": "",
+        "context_index": None, # Embedded chunks for retrieval
         "topic_name": "",
         "history": [],
         "elo": 1200,
@@ -252,7 +601,14 @@ if 'quiz_state' not in st.session_state:
         "q_count": 0,
         "start_time": None,
         "q_start_timestamp": None, # For timer
-        "hint_used": False
+        "hint_used": False,
+        "q_queue": {}, # Difficulty label -> pre-generated questions
+        "q_refill": None, # In-flight batch generation
+        "pending": None, # In-flight evaluation + speculative next questions
+        "q_prefetch": None, # Speculative question for the outcome that happened
+        "bandit": new_bandit(), # Question-type selector
+        "report": None, # Analytics report future
+        "recent_tags": [] # Topic tags of the last 3 questions
     }
 
 # --- Sidebar ---
@@ -266,6 +622,7 @@ with st.sidebar:
     source = st.radio("Source Material", ["Topic", "Upload PDF"])
     context_input = ""
     topic_name_input = "" 
+    pdf_hash = None
 
     if source == "Topic":
         topic_name_input = st.text_input("Enter Subject/Topic", "Literary Theory")
@@ -274,6 +631,7 @@ with st.sidebar:
         pdf = st.file_uploader("Upload PDF", type="pdf")
         if pdf:
             topic_name_input = pdf.name 
+            pdf_hash = hashlib.md5(pdf.getvalue()).hexdigest()
             with st.spinner("Processing PDF..."):
                 context_input = extract_text_from_pdf(pdf)
                 if context_input: st.success("PDF Loaded!")
@@ -284,11 +642,14 @@ with st.sidebar:
         if api_key and context_input:
             st.session_state.openai_key = api_key
             start_elo = load_topic_data(topic_name_input)
+            with st.spinner("Indexing content..."):
+                context_index = build_context_index(get_openai_client(api_key), context_input, topic_name_input, pdf_hash)
             
             st.session_state.quiz_state = {
                 "active": True,
                 "finished": False,
                 "context": context_input,
+                "context_index": context_index,
                 "topic_name": topic_name_input,
                 "history": [],
                 "elo": start_elo,
@@ -299,7 +660,14 @@ with st.sidebar:
                 "q_count": 0,
                 "start_time": time.time(),
                 "q_start_timestamp": None,
-                "hint_used": False
+                "hint_used": False,
+                "q_queue": {},
+                "q_refill": None,
+                "pending": None,
+                "q_prefetch": None,
+                "bandit": new_bandit(),
+                "report": None,
+                "recent_tags": []
             }
             st.rerun()
         else:
@@ -321,22 +689,33 @@ if not qs["active"]:
     """)
 
 elif qs["finished"]:
+    # Start the report first so its latency overlaps with rendering metrics and charts.
+    # The future is kept in session state so later reruns reuse the same report.
+    if qs["report"] is None:
+        client = get_openai_client(st.session_state.openai_key)
+        qs["report"] = _executor.submit(generate_analytics_report, client, list(qs['history']), qs['context'])
+    
     st.balloons()
     st.header("📊 Quiz Results")
     
+    # One DataFrame feeds both the metrics and the charts
+    df = pd.DataFrame(qs['history']).assign(q_num=lambda d: np.arange(1, len(d) + 1))
+    if len(df):
+        stats = df.agg({"is_correct": "mean", "streak": "max"})
+        first_elo = df["elo_after"].iloc[0]
+    else:
+        stats = pd.Series({"is_correct": 0, "streak": 0})
+        first_elo = qs["elo"]
+    
     # Summary Metrics
     c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Final Elo", qs["elo"], delta=qs["elo"] - qs["history"][0]["elo_after"] if qs["history"] else 0)
+    c1.metric("Final Elo", qs["elo"], delta=int(qs["elo"] - first_elo))
     c2.metric("Total Score", qs["total_score"])
-    c3.metric("Max Streak", max([h.get('streak',0) for h in qs['history']] + [0]))
-    accuracy = sum(1 for h in qs['history'] if h['is_correct']) / len(qs['history'])
-    c4.metric("Accuracy", f"{accuracy:.0%}")
+    c3.metric("Max Streak", int(stats["streak"]))
+    c4.metric("Accuracy", f"{stats['is_correct']:.0%}")
 
     # Charts
-    if qs['history']:
-        df = pd.DataFrame(qs['history'])
-        df['q_num'] = range(1, len(df) + 1)
-        
+    if len(df):
         tab1, tab2 = st.tabs(["Difficulty Trend", "Time & Score"])
         with tab1:
             fig = px.line(df, x='q_num', y='elo_after', title='Elo Rating Progression', markers=True)
@@ -345,18 +724,72 @@ elif qs["finished"]:
             fig2 = px.bar(df, x='q_num', y='score_gained', color='is_correct', title='Score per Question')
             st.plotly_chart(fig2, use_container_width=True)
 
-    client = get_openai_client(st.session_state.openai_key)
     with st.spinner("Generating Learning Path..."):
-        report = generate_analytics_report(client, qs['history'], qs['context'])
+        try:
+            report = qs["report"].result()
+        except Exception as e:
+            report = None
+            qs["report"] = None # Retry on the next rerun
+            st.error(f"Error generating report: {e}")
     
-    st.markdown("### 📝 Personalized Study Plan")
-    st.markdown(report)
+    if report:
+        st.markdown("### 📝 Personalized Study Plan")
+        st.markdown(report)
     
     if st.button("Restart"):
         st.session_state.quiz_state["active"] = False
         st.rerun()
 
 else:
+    # --- Resolve Pending Evaluation ---
+    if qs["pending"]:
+        pending = qs["pending"]
+        q_data = qs["current_q"]
+        with st.spinner("Analyzing your response..."):
+            # Show the grader's explanation as it streams in
+            preview = st.empty()
+            while not pending["evaluation"].done():
+                partial = partial_json_field("".join(pending["stream"]), "explanation")
+                if partial:
+                    preview.markdown(f"**Feedback:** {partial}")
+                time.sleep(0.1)
+            preview.empty()
+            result = pending["evaluation"].result()
+            qs["feedback"] = result
+            
+            is_correct = bool(result.get('is_correct', False))
+            score_pct = result.get('score_percentage', 0)
+            if score_pct > 70: is_correct = True
+            
+            score_base = score_pct 
+            if qs["hint_used"]: score_base -= 50
+            
+            qs["elo"] = pending["elo_if_correct"] if is_correct else pending["elo_if_wrong"]
+            save_topic_data(qs["topic_name"], qs["elo"])
+            
+            qs["streak"] = qs["streak"] + 1 if is_correct else 0
+            qs["total_score"] += max(0, score_base)
+            update_bandit(qs["bandit"], q_data.get('type'), is_correct)
+            
+            qs["history"].append({
+                "question": q_data['question'],
+                "user_answer": pending["user_answer"],
+                "is_correct": is_correct,
+                "score_gained": max(0, score_base),
+                "elo_after": qs["elo"],
+                "streak": qs["streak"]
+            })
+            
+            # Keep the question generated for the outcome that happened (resolved once
+            # the next question is needed), drop the other
+            next_q = pending["next_q"][is_correct]
+            if next_q is not None:
+                qs["q_prefetch"] = next_q
+            other_q = pending["next_q"][not is_correct]
+            if other_q is not None and other_q is not next_q:
+                other_q.cancel()
+        qs["pending"] = None
+
     # --- HUD ---
     diff_name, diff_class, diff_rating_est = get_difficulty_label(qs["elo"])
     
@@ -375,31 +808,80 @@ else:
     if not qs["current_q"]:
         client = get_openai_client(st.session_state.openai_key)
         with st.spinner("AI is formulating a challenge..."):
-            q_data = generate_question(client, qs["context"], qs["elo"], qs["history"])
+            collect_refill(qs)
+            collect_refill(qs, key="q_prefetch")
+            tier_queue = qs["q_queue"].setdefault(diff_name, [])
+            if not tier_queue:
+                collect_refill(qs, wait=True, key="q_prefetch")
+            for _ in range(2): # A refill already in flight may not cover this tier
+                if tier_queue:
+                    break
+                schedule_refill(qs, client)
+                collect_refill(qs, wait=True)
+            q_data = pop_question(tier_queue, choose_question_type(qs["bandit"]))
+            if q_data:
+                tags = q_data.get('topic_tags')
+                tags = [str(t) for t in tags] if isinstance(tags, list) else []
+                qs["recent_tags"] = (qs["recent_tags"] + [tags])[-3:]
+            if queue_needs_refill(qs):
+                schedule_refill(qs, client)
             if q_data:
                 qs["current_q"] = q_data
                 qs["hint_used"] = False
                 qs["q_start_timestamp"] = time.time() # Start Timer
                 st.rerun()
+            else:
+                st.error("Could not generate a question. Please try again.")
+                st.stop()
 
     # --- Question Display ---
     q_data = qs["current_q"]
     st.divider()
     
     # Timer Display Logic
+    # Counts down in the browser so the clock stays live without reruns;
+    # the submit handler's elapsed-time check remains the authority.
     elapsed = time.time() - qs["q_start_timestamp"]
-    remaining = 120 - elapsed
+    remaining = max(0, int(120 - elapsed))
     
-    if remaining > 0:
-        st.markdown(f"<div class='timer-box'>⏳ Time Remaining: {int(remaining)}s</div>", unsafe_allow_html=True)
-        # Warning if low
-        if remaining < 30:
-            st.warning("⚠️ Less than 30 seconds remaining!")
-    else:
-        st.markdown(f"<div class='timer-box' style='color:red; border-color:red;'>⌛ TIME EXPIRED</div>", unsafe_allow_html=True)
-
-    st.markdown(f"### Question:")
-    st.markdown(f"#### {q_data['question']}")
+    components.html(f"""
+    <style>
+        .timer-box {{
+            font-family: sans-serif;
+            font-size: 20px;
+            font-weight: bold;
+            color: #d32f2f;
+            padding: 10px;
+            border: 2px solid #d32f2f;
+            border-radius: 5px;
+            text-align: center;
+        }}
+        .timer-warning {{ font-family: sans-serif; color: #8a6d00; text-align: center; margin-top: 6px; }}
+    </style>
+    <div id="timer" class="timer-box"></div>
+    <div id="timer-warning" class="timer-warning"></div>
+    <script>
+        let s = {remaining};
+        const el = document.getElementById("timer");
+        const warn = document.getElementById("timer-warning");
+        function tick() {{
+            if (s > 0) {{
+                el.innerText = "⏳ Time Remaining: " + s + "s";
+                warn.innerText = s < 30 ? "⚠️ Less than 30 seconds remaining!" : "";
+            }} else {{
+                el.innerText = "⌛ TIME EXPIRED";
+                el.style.color = "red";
+                el.style.borderColor = "red";
+                warn.innerText = "";
+            }}
+            s--;
+        }}
+        tick();
+        setInterval(tick, 1000);
+    </script>
+    """, height=90)
+
+    st.markdown(f"### Question:\n#### {q_data['question']}")
     
     # Hint System
     if not qs["hint_used"]:
@@ -440,42 +922,40 @@ else:
                 qs["elo"] = calculate_elo(qs["elo"], False, qs["elo"]) # Treat as loss against equal rating
                 save_topic_data(qs["topic_name"], qs["elo"])
                 qs["streak"] = 0
+                update_bandit(qs["bandit"], q_data.get('type'), False)
                 st.rerun()
             
             elif not user_input:
                 st.warning("Please provide a response.")
             else:
                 client = get_openai_client(st.session_state.openai_key)
-                with st.spinner("Analyzing your response..."):
-                    result = evaluate_answer(client, q_data, user_input, qs["context"])
-                    qs["feedback"] = result
-                    
-                    is_correct = result.get('is_correct', False)
-                    score_pct = result.get('score_percentage', 0)
-                    if score_pct > 70: is_correct = True
-                    
-                    score_base = score_pct 
-                    if qs["hint_used"]: score_base -= 50
-                    
-                    _, _, q_diff_rating = get_difficulty_label(qs["elo"])
-                    q_rating_actual = q_data.get('difficulty_rating_estimate', q_diff_rating)
-                    
-                    qs["elo"] = calculate_elo(qs["elo"], is_correct, q_rating_actual)
-                    save_topic_data(qs["topic_name"], qs["elo"])
-                    
-                    qs["streak"] = qs["streak"] + 1 if is_correct else 0
-                    qs["total_score"] += max(0, score_base)
-                    
-                    qs["history"].append({
-                        "question": q_data['question'],
-                        "user_answer": user_input,
-                        "is_correct": is_correct,
-                        "score_gained": max(0, score_base),
-                        "elo_after": qs["elo"],
-                        "streak": qs["streak"]
-                    })
-                    
-                    st.rerun()
+                # Start grading first; everything below only overlaps with it
+                stream = []
+                evaluation = _grading_executor.submit(evaluate_answer, client, q_data, user_input, qs["context_index"], stream)
+                
+                # Top up the queue now so generation overlaps with grading
+                collect_refill(qs)
+                if queue_needs_refill(qs):
+                    schedule_refill(qs, client)
+                _, _, q_diff_rating = get_difficulty_label(qs["elo"])
+                q_rating_actual = q_data.get('difficulty_rating_estimate', q_diff_rating)
+                elo_if_correct, elo_if_wrong = (int(e) for e in calculate_elo_batch(qs["elo"], [1, 0], q_rating_actual))
+                
+                # Generate the next question (for both outcomes) while grading runs
+                next_if_correct = prefetch_question(qs, client, elo_if_correct)
+                if get_difficulty_label(elo_if_correct)[0] == get_difficulty_label(elo_if_wrong)[0]:
+                    next_if_wrong = next_if_correct
+                else:
+                    next_if_wrong = prefetch_question(qs, client, elo_if_wrong)
+                qs["pending"] = {
+                    "evaluation": evaluation,
+                    "stream": stream,
+                    "user_answer": user_input,
+                    "elo_if_correct": elo_if_correct,
+                    "elo_if_wrong": elo_if_wrong,
+                    "next_q": {True: next_if_correct, False: next_if_wrong},
+                }
+                st.rerun()
 
     # --- Feedback ---
     if qs["feedback"]: